@@ -1,157 +1,401 @@
-import logging
-import time
-import re
-import datetime
-import json
-
-from flask import Flask, request, jsonify
-from flask_sqlalchemy import SQLAlchemy
-from openai import OpenAI
-
-# -----------------------
-# Flask 应用及数据库配置
-# -----------------------
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///api_calls.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-db = SQLAlchemy(app)
-
-# -----------------------
-# 日志配置（utf-8编码）
-# -----------------------
-logging.basicConfig(
-    filename='./root.log',
-    level=logging.INFO,
-    format='%(asctime)s [PID %(process)d] [Thread %(thread)d] %(module)s:%(lineno)d %(levelname)s: %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S', encoding='utf-8'
-)
-logger = logging.getLogger(__name__)
-
-# -----------------------
-# SQLAlchemy 数据模型
-# -----------------------
-class APICall(db.Model):
-    __tablename__ = 'api_calls'
-    uuid = db.Column(db.String(64), primary_key=True)
-    messages = db.Column(db.Text, nullable=False)
-    model = db.Column(db.String(64), nullable=False)
-    response_format = db.Column(db.String(64), nullable=False)
-    temperature = db.Column(db.Float, nullable=False)
-    reply = db.Column(db.Text, nullable=True)
-    prompt_tokens = db.Column(db.Integer, nullable=True)
-    completion_tokens = db.Column(db.Integer, nullable=True)
-    total_tokens = db.Column(db.Integer, nullable=True)
-    call_duration = db.Column(db.Float, nullable=False)
-    error_flag = db.Column(db.Integer, nullable=False, default=0)
-    call_time = db.Column(db.DateTime, nullable=False)
-    request_ip = db.Column(db.String(64), nullable=False)
-
-with app.app_context():
-    db.create_all()
-
-# -----------------------
-# API 接口实现
-# -----------------------
-@app.route('/api/call', methods=['POST'])
-def call_openai():
-    data = request.get_json()
-    if not data:
-        return jsonify({'error': '无效的JSON数据'}), 400
-
-    # 提取参数
-    api_key = data.get('api_key')
-    messages = data.get('messages')
-    model_name = data.get('model')
-    response_format = data.get('response_format', 'text')
-    uuid = data.get('uuid')
-    temperature = data.get('temperature', 1.0)
-
-    logger.info(f"[{uuid}]********** Start **********")
-    logging.info(
-        f'[{uuid}]Get a chat request from ip: {request.remote_addr}, model: {model_name}, response_format: {response_format}, temperature: {temperature}')
-
-    if not all([api_key, messages, model_name, response_format, uuid]):
-        logger.error(f"[{uuid}]缺少必要参数")
-        return jsonify({'error': '缺少必要参数'}), 400
-
-    # 设置 OpenAI API 密钥
-    client = OpenAI(api_key=api_key)
-
-    # 记录开始时间
-    start_time = time.time()
-    try:
-        if response_format == 'json':
-            response = client.chat.completions.create(
-                model=model_name,
-                messages=messages,
-                temperature=temperature,
-                response_format={"type": "json_object"}
-            )
-        elif response_format == 'text':
-            response = client.chat.completions.create(
-                model=model_name,
-                messages=messages,
-                temperature=temperature,
-            )
-        else:
-            raise AttributeError('Error response_format')
-    except Exception as e:
-        logger.error(f"[{uuid}]调用 OpenAI API 失败: {str(e)}")
-        return jsonify({'error': '调用 OpenAI API 失败', 'details': str(e)}), 500
-
-    # 记录调用时长
-    duration = time.time() - start_time
-
-    # 解析 API 返回结果
-    reply = response.choices[0].message.content
-    prompt_tokens = response.usage.prompt_tokens
-    completion_tokens = response.usage.completion_tokens
-    total_tokens = response.usage.total_tokens
-
-    # 使用正则表达式检查 reply 中换行符连续出现4个或以上
-    error_flag = 1 if re.search(r'[\n\r]{4,}', reply) else 0
-
-    # 使用 SQLAlchemy 保存调用记录（确保中文以 utf-8 编码存储）
-    call_record = APICall(
-        uuid=uuid,
-        messages=json.dumps(messages, ensure_ascii=False),
-        model=model_name,
-        response_format=response_format,
-        temperature=temperature,
-        reply=reply,
-        prompt_tokens=prompt_tokens,
-        completion_tokens=completion_tokens,
-        total_tokens=total_tokens,
-        call_duration=duration,
-        error_flag=error_flag,
-        call_time=datetime.datetime.utcnow(),
-        request_ip=request.remote_addr or 'unknown',
-    )
-
-    try:
-        db.session.add(call_record)
-        db.session.commit()
-    except Exception as e:
-        logger.error(f"[{uuid}]数据库错误: {str(e)}")
-        db.session.rollback()
-        return jsonify({'error': '数据库错误', 'details': str(e)}), 500
-
-    # 打印日志
-    logger.info(f"[{uuid}]API调用记录 IP: {request.remote_addr}, 时长: {duration}秒, error_flag: {error_flag}")
-    logger.info(f"[{uuid}]Prompt_tokens: {prompt_tokens}")
-    logger.info(f"[{uuid}]completion_tokens: {completion_tokens}")
-    logger.info(f"[{uuid}]total_tokens: {total_tokens}")
-
-    # 返回 OpenAI 的部分返回值及调用信息
-    return jsonify({
-        'reply': reply,
-        'prompt_tokens': prompt_tokens,
-        'completion_tokens': completion_tokens,
-        'total_tokens': total_tokens,
-        'call_duration': duration,
-        'error_flag': error_flag,
-    })
-
-if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
+import asyncio
+import functools
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import time
+import os
+import re
+import queue
+import threading
+
+import httpx
+import orjson
+import zstandard as zstd
+from fastapi import BackgroundTasks, FastAPI, Request
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, ValidationError
+from sqlalchemy import create_engine, event, text, Column, Index, String, Text, Float, Integer, BigInteger, LargeBinary
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import QueuePool
+from openai import AsyncOpenAI, APIConnectionError, APITimeoutError, RateLimitError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+
+# -----------------------
+# FastAPI 应用及数据库配置
+# -----------------------
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# 常驻连接池：避免每次请求重新 open/close 数据库文件；
+# SQLite 写入本身是串行的，所以写路径额外用一把互斥锁串行化，避免 SQLITE_BUSY 重试
+engine = create_engine(
+    'sqlite:///api_calls.db',
+    poolclass=QueuePool,
+    pool_size=16,
+    max_overflow=0,
+    pool_pre_ping=False,
+    connect_args={'check_same_thread': False},
+)
+Base = declarative_base()
+
+_write_lock = threading.Lock()
+
+_zstd_compressor = zstd.ZstdCompressor(level=3)
+_zstd_decompressor = zstd.ZstdDecompressor()
+
+def decompress_messages(blob):
+    return orjson.loads(_zstd_decompressor.decompress(blob))
+
+# 检查 reply 中换行符连续出现4个或以上。
+# 常见情况（纯 \n，或根本没有 \r）走 C 层的子串查找，
+# 只有出现 \r 时才回退到正则处理 \n/\r 混排的情况
+_NL_RUN_RE = re.compile(r'[\n\r]{4,}')
+
+def _has_newline_run(text):
+    if '\n\n\n\n' in text:
+        return True
+    if '\r' not in text:
+        return False
+    return _NL_RUN_RE.search(text) is not None
+
+# -----------------------
+# SQLite PRAGMA 调优（WAL 模式允许读写并发，NORMAL 同步减少每次 commit 的 fsync）
+# -----------------------
+@event.listens_for(engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in (
+        "journal_mode=WAL",
+        "synchronous=NORMAL",
+        "temp_store=MEMORY",
+        "mmap_size=268435456",
+        "cache_size=-64000",
+        "busy_timeout=5000",
+    ):
+        cursor.execute(f"PRAGMA {pragma}")
+    cursor.close()
+
+# -----------------------
+# 日志配置（utf-8编码）：请求线程只把日志记录入队，
+# 由 QueueListener 在后台线程格式化并写文件，避免在请求路径上做磁盘写入
+# -----------------------
+_log_q = queue.Queue(-1)
+_log_file_handler = logging.FileHandler('./root.log', encoding='utf-8')
+_log_file_handler.setFormatter(logging.Formatter(
+    '%(asctime)s [PID %(process)d] [Thread %(thread)d] %(module)s:%(lineno)d %(levelname)s: %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+))
+_root_logger = logging.getLogger()
+_root_logger.addHandler(QueueHandler(_log_q))
+_root_logger.setLevel(logging.INFO)
+_log_listener = QueueListener(_log_q, _log_file_handler, respect_handler_level=True)
+_log_listener.start()
+logger = logging.getLogger(__name__)
+
+# -----------------------
+# SQLAlchemy 数据模型
+# -----------------------
+class APICall(Base):
+    __tablename__ = 'api_calls'
+    uuid = Column(String(64), primary_key=True)
+    # 聊天记录以 zstd 压缩的 JSON 存储：transcript 冗余度高，压缩后
+    # 每次插入触达的页数和 WAL 体积都小得多，用 decompress_messages 读取
+    messages = Column(LargeBinary, nullable=False)
+    model = Column(String(64), nullable=False)
+    response_format = Column(String(64), nullable=False)
+    temperature = Column(Float, nullable=False)
+    reply = Column(Text, nullable=True)
+    prompt_tokens = Column(Integer, nullable=True)
+    completion_tokens = Column(Integer, nullable=True)
+    total_tokens = Column(Integer, nullable=True)
+    call_duration = Column(Float, nullable=False)
+    error_flag = Column(Integer, nullable=False, default=0)
+    # Unix 毫秒时间戳：整数绑定比 DateTime 的类型转换更快，索引也更省
+    call_time = Column(BigInteger, nullable=False)
+    request_ip = Column(String(64), nullable=False)
+
+    # 只建常用查询会用到的索引：每多一个索引，插入就多一次 B 树写入。
+    # 复合索引的前缀已覆盖按 call_time 的查询，不再单独建 call_time 索引
+    __table_args__ = (
+        Index('ix_calltime_err', 'call_time', 'error_flag'),
+        Index('ix_model', 'model'),
+        Index('ix_ip', 'request_ip'),
+    )
+
+# 多个 gunicorn worker 会并发执行这段导入期 DDL：
+# create_all 的 checkfirst 是先查后建，撞上时输家会报"已存在"，吞掉即可
+try:
+    Base.metadata.create_all(engine)
+except OperationalError:
+    pass
+
+# create_all 只建新表：已有部署的 api_calls 表不会被补上索引，这里单独按需创建。
+# IF NOT EXISTS 的检查在 SQLite 写锁内完成，worker 并发启动没有竞态。
+# 旧库的 call_time/messages 数据格式迁移见 migrate_db.py
+with engine.begin() as conn:
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_calltime_err ON api_calls (call_time, error_flag)'))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_model ON api_calls (model)'))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_ip ON api_calls (request_ip)'))
+
+# 进程内只构建一次 INSERT 语句，后台写入线程每批直接复用
+_APICALL_INSERT = APICall.__table__.insert()
+
+# -----------------------
+# OpenAI 客户端复用（共享 HTTP 连接池，避免每次请求重新建立 TCP/TLS 连接）
+# -----------------------
+_shared_http = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+    # 读超时对齐 nginx 的 proxy_read_timeout 240s（gunicorn timeout 为 300s），
+    # 长补全不会在客户端先行超时
+    timeout=httpx.Timeout(60, read=240),
+)
+
+@functools.lru_cache(maxsize=256)
+def get_client(api_key):
+    # max_retries=0：重试统一由下面的 tenacity 策略负责，
+    # 不与 openai 客户端内置的重试叠加成倍放大上游调用
+    return AsyncOpenAI(api_key=api_key, http_client=_shared_http, max_retries=0)
+
+# 客户端限流：并发的 OpenAI 调用不超过 OPENAI_CONCURRENCY，
+# 429/超时/连接错误按指数退避重试，避免超 RPM 后的请求白跑一趟
+_openai_sem = asyncio.Semaphore(int(os.getenv('OPENAI_CONCURRENCY', '8')))
+
+@retry(stop=stop_after_attempt(5),
+       wait=wait_exponential_jitter(initial=1, max=30),
+       retry=retry_if_exception_type((RateLimitError, APITimeoutError, APIConnectionError)),
+       reraise=True)
+async def _create_chat_completion(client, **kwargs):
+    # 信号量放在重试内部，退避等待期间不占用并发额度
+    async with _openai_sem:
+        return await client.chat.completions.create(**kwargs)
+
+# -----------------------
+# 请求参数模型
+# -----------------------
+class CallRequest(BaseModel):
+    api_key: str
+    messages: list
+    model: str
+    response_format: str = 'text'
+    uuid: str
+    temperature: float = 1.0
+    stream: bool = False
+
+# 请求体大小上限（与 nginx 的 client_max_body_size 一致）
+_MAX_BODY_BYTES = 10 * 1024 * 1024
+
+# -----------------------
+# 数据库后台批量写入：请求路径只入队，后台线程按批落库，
+# 把事务/fsync 开销摊到整批记录上（进程崩溃时可能丢失队列中
+# 未落库的记录——此时响应已经返回给调用方，可以接受）
+# -----------------------
+_write_q = queue.Queue()
+_BATCH_MAX_ROWS = 256
+_BATCH_MAX_WAIT = 0.05
+
+def _drain():
+    while True:
+        rows = [_write_q.get()]
+        deadline = time.time() + _BATCH_MAX_WAIT
+        while len(rows) < _BATCH_MAX_ROWS:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                rows.append(_write_q.get(timeout=timeout))
+            except queue.Empty:
+                break
+        try:
+            with _write_lock, engine.begin() as conn:
+                conn.execute(_APICALL_INSERT, rows)
+        except Exception as e:
+            # 整批插入是原子的，一条坏记录（典型如客户端重试带来的 uuid 重复）
+            # 会让全批回滚；退化为逐条写入，只丢弃真正冲突的那条
+            logger.error(f"数据库批量写入失败，改为逐条写入: {str(e)}")
+            for row in rows:
+                try:
+                    with _write_lock, engine.begin() as conn:
+                        conn.execute(_APICALL_INSERT, row)
+                except Exception as e:
+                    logger.error(f"[{row.get('uuid')}]调用记录写入失败（已丢弃）: {str(e)}")
+
+threading.Thread(target=_drain, daemon=True).start()
+
+# -----------------------
+# 流式返回：逐段把增量内容以 SSE 推给调用方，降低首字节延迟；
+# 流结束后汇总 reply/token 信息，照常交给后台写入线程落库
+# -----------------------
+async def _stream_reply(response, uuid, messages, model_name, response_format,
+                        temperature, request_ip, start_time):
+    parts = []
+    usage = None
+    record = None
+
+    # 不管流怎样结束都要落库：客户端断开时 GeneratorExit 会从当前 yield
+    # 抛出，读流出错时也会提前返回，而这些调用 OpenAI 都已计费，
+    # 已收到的部分内容和 usage 同样要写入记录（确保中文以 utf-8 编码存储）
+    def _persist():
+        duration = time.time() - start_time
+        reply = ''.join(parts)
+        # 检查 reply 中换行符连续出现4个或以上
+        error_flag = 1 if _has_newline_run(reply) else 0
+        row = {
+            'uuid': uuid,
+            'messages': _zstd_compressor.compress(orjson.dumps(messages)),
+            'model': model_name,
+            'response_format': response_format,
+            'temperature': temperature,
+            'reply': reply,
+            'prompt_tokens': usage.prompt_tokens if usage else None,
+            'completion_tokens': usage.completion_tokens if usage else None,
+            'total_tokens': usage.total_tokens if usage else None,
+            'call_duration': duration,
+            'error_flag': error_flag,
+            'call_time': int(start_time * 1000),
+            'request_ip': request_ip,
+        }
+        _write_q.put(row)
+        # 打印日志（一次调用只产生一条记录）
+        logger.info(
+            f"[{uuid}] ip={request_ip} model={model_name} fmt={response_format} "
+            f"temp={temperature} dur={duration:.3f}s err={error_flag} "
+            f"pt={row['prompt_tokens']} ct={row['completion_tokens']} "
+            f"tt={row['total_tokens']} stream=1")
+        return row
+
+    try:
+        try:
+            async for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                    yield b'data: ' + orjson.dumps({'delta': chunk.choices[0].delta.content}) + b'\n\n'
+                if chunk.usage:
+                    usage = chunk.usage
+        except Exception as e:
+            logger.error(f"[{uuid}]流式读取 OpenAI 响应失败: {str(e)}")
+            yield b'data: ' + orjson.dumps({'error': '调用 OpenAI API 失败', 'details': str(e)}) + b'\n\n'
+            yield b'data: [DONE]\n\n'
+            return
+
+        record = _persist()
+
+        # 结尾推送调用信息汇总，再发 [DONE] 结束
+        yield b'data: ' + orjson.dumps({
+            'prompt_tokens': record['prompt_tokens'],
+            'completion_tokens': record['completion_tokens'],
+            'total_tokens': record['total_tokens'],
+            'call_duration': record['call_duration'],
+            'error_flag': record['error_flag'],
+        }) + b'\n\n'
+        yield b'data: [DONE]\n\n'
+    finally:
+        if record is None:
+            _persist()
+
+# -----------------------
+# API 接口实现
+# -----------------------
+@app.post('/api/call')
+async def call_openai(request: Request, background_tasks: BackgroundTasks):
+    # 直接读原始请求体，由 pydantic-core 的 Rust 解析器一步完成
+    # JSON 解析 + 校验，跳过 FastAPI 默认的 json.loads 中转
+    raw = await request.body()
+    if len(raw) > _MAX_BODY_BYTES:
+        return ORJSONResponse(status_code=413, content={'error': '请求体过大'})
+    try:
+        req = CallRequest.model_validate_json(raw)
+    except ValidationError as e:
+        return ORJSONResponse(status_code=400, content={'error': '无效的JSON数据', 'details': str(e)})
+
+    # 提取参数
+    api_key = req.api_key
+    messages = req.messages
+    model_name = req.model
+    response_format = req.response_format
+    uuid = req.uuid
+    temperature = req.temperature
+    request_ip = request.client.host if request.client else 'unknown'
+
+    if not (api_key and messages and model_name and response_format and uuid):
+        logger.error(f"[{uuid}]缺少必要参数")
+        return ORJSONResponse(status_code=400, content={'error': '缺少必要参数'})
+
+    # 复用 OpenAI 客户端（按 api_key 缓存）
+    client = get_client(api_key)
+
+    # 只构建一份调用参数：json 模式多一个 response_format，
+    # 流式请求额外带上 stream 参数，并让最后一个 chunk 附带 usage
+    kwargs = {'model': model_name, 'messages': messages, 'temperature': temperature}
+    if response_format == 'json':
+        kwargs['response_format'] = {"type": "json_object"}
+    elif response_format != 'text':
+        logger.error(f"[{uuid}]Error response_format: {response_format}")
+        return ORJSONResponse(status_code=400, content={'error': 'Error response_format'})
+    if req.stream:
+        kwargs['stream'] = True
+        kwargs['stream_options'] = {'include_usage': True}
+
+    # 记录开始时间
+    start_time = time.time()
+    try:
+        response = await _create_chat_completion(client, **kwargs)
+    except Exception as e:
+        logger.error(f"[{uuid}]调用 OpenAI API 失败: {str(e)}")
+        return ORJSONResponse(status_code=500, content={'error': '调用 OpenAI API 失败', 'details': str(e)})
+
+    # 流式模式：拿到流就开始往回推增量内容，落库和日志在流结束后进行
+    if req.stream:
+        return StreamingResponse(
+            _stream_reply(response, uuid, messages, model_name, response_format,
+                          temperature, request_ip, start_time),
+            media_type='text/event-stream')
+
+    # 记录调用时长
+    duration = time.time() - start_time
+
+    # 解析 API 返回结果
+    reply = response.choices[0].message.content
+    prompt_tokens = response.usage.prompt_tokens
+    completion_tokens = response.usage.completion_tokens
+    total_tokens = response.usage.total_tokens
+
+    # 检查 reply 中换行符连续出现4个或以上
+    error_flag = 1 if _has_newline_run(reply) else 0
+
+    # 保存调用记录：响应发出后再入队，由后台写入线程批量落库（确保中文以 utf-8 编码存储）
+    background_tasks.add_task(_write_q.put, {
+        'uuid': uuid,
+        'messages': _zstd_compressor.compress(orjson.dumps(messages)),
+        'model': model_name,
+        'response_format': response_format,
+        'temperature': temperature,
+        'reply': reply,
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'total_tokens': total_tokens,
+        'call_duration': duration,
+        'error_flag': error_flag,
+        'call_time': int(start_time * 1000),
+        'request_ip': request_ip,
+    })
+
+    # 打印日志（一次调用只产生一条记录）
+    logger.info(
+        f"[{uuid}] ip={request_ip} model={model_name} fmt={response_format} "
+        f"temp={temperature} dur={duration:.3f}s err={error_flag} "
+        f"pt={prompt_tokens} ct={completion_tokens} tt={total_tokens}")
+
+    # 返回 OpenAI 的部分返回值及调用信息
+    return {
+        'reply': reply,
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'total_tokens': total_tokens,
+        'call_duration': duration,
+        'error_flag': error_flag,
+    }
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=5000)
@@ -0,0 +1,25 @@
+# gunicorn 部署配置（ASGI）：
+#   gunicorn -c conf_gunicorn.py app:app
+# 每个 worker 一个事件循环，等待 OpenAI 响应时不会占用线程，
+# 单 worker 即可同时挂起大量 /api/call 请求
+import multiprocessing
+
+chdir = '/root/OpenAITokenTest'
+wsgi_app = 'app:app'
+
+worker_class = 'uvicorn.workers.UvicornWorker'
+workers = multiprocessing.cpu_count()
+
+bind = 'unix:sock_uwsgi_openai_token_test_app.sock'
+# 0o777 & ~0o111 = 0o666，对应原 uwsgi 的 chmod-socket=666
+umask = 0o111
+# socket 只有本机 nginx 能连，信任其 X-Forwarded-For 以记录真实客户端 IP
+forwarded_allow_ips = '*'
+
+# 对应原 uwsgi 的 harakiri=300
+timeout = 300
+graceful_timeout = 30
+
+daemon = True
+pidfile = 'pid_gunicorn_openai_token_test_app.pid'
+errorlog = 'log_gunicorn_openai_token_test_app.log'
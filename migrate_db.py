@@ -0,0 +1,40 @@
+# 一次性迁移脚本：把旧版 app.py 写入的数据迁到当前 schema。
+# 用法（先停服务再执行）：
+#   python migrate_db.py [api_calls.db 路径]
+# 1. call_time：DATETIME 文本 -> Unix 毫秒整数
+# 2. messages：utf-8 JSON 文本 -> zstd 压缩的 JSON
+# 3. 补建分析查询用的索引
+# 脚本可重复执行，已迁移的行会被跳过
+import sqlite3
+import sys
+
+import orjson
+import zstandard as zstd
+
+def migrate(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        # call_time：julianday 按 UTC 解析，与旧版 utcnow() 写入一致
+        n = conn.execute(
+            "UPDATE api_calls "
+            "SET call_time = CAST((julianday(call_time) - 2440587.5) * 86400000 AS INTEGER) "
+            "WHERE typeof(call_time) = 'text'").rowcount
+        print(f'call_time: 迁移 {n} 行')
+
+        cctx = zstd.ZstdCompressor(level=3)
+        rows = conn.execute(
+            "SELECT uuid, messages FROM api_calls WHERE typeof(messages) = 'text'").fetchall()
+        for uuid, messages in rows:
+            blob = cctx.compress(orjson.dumps(orjson.loads(messages)))
+            conn.execute('UPDATE api_calls SET messages = ? WHERE uuid = ?', (blob, uuid))
+        print(f'messages: 迁移 {len(rows)} 行')
+
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_calltime_err ON api_calls (call_time, error_flag)')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_model ON api_calls (model)')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_ip ON api_calls (request_ip)')
+        conn.commit()
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    migrate(sys.argv[1] if len(sys.argv) > 1 else 'api_calls.db')